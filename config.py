@@ -6,6 +6,10 @@ conf_path = '/var/lib/zope4/ema/etc/zope.conf'
 # with zodbsync watch
 datafs_path = '/var/lib/zope4/zeo/var/Data.fs'
 
+# File where zodbsync watch keeps its object tree between runs to speed up
+# starting
+#watch_tree_cache = '/var/cache/perfact/zodbsync-watch-tree'
+
 # user that is used to create commits
 manager_user = 'perfact'
 
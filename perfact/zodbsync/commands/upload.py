@@ -1,16 +1,12 @@
 #!/usr/bin/env python
 
 import os
-import sys
 import warnings
 
 from ..subcommand import SubCommand
 from ..zodbsync import mod_format
 
 
-PY2 = (sys.version_info.major == 2)
-
-
 def create_template(type, content_type=None):
     result = {'type': type, 'title': ''}
     if content_type is not None:
@@ -110,10 +106,7 @@ class Upload(SubCommand):
 
             # repodir folder creation
             new_folder = os.path.join(filesystem_path, cur_dir)
-            if PY2:
-                os.makedirs(new_folder)
-            else:
-                os.makedirs(new_folder, exist_ok=True)
+            os.makedirs(new_folder, exist_ok=True)
 
             # do not forget meta file for folder
             self.create_file(
@@ -1,21 +1,53 @@
 #!/usr/bin/env python
 
 import base64
+import mmap
+import os
 import signal
 import time
 import threading
 import sys
 import pickle
+import struct
 import subprocess
 
 # For reading the Data.FS in order to obtain affected object IDs from
 # transaction IDs
 import ZODB.FileStorage
+from ZODB.FileStorage.format import DATA_HDR, DATA_HDR_LEN
+from ZODB.utils import p64, u64
 
 from ..subcommand import SubCommand
 from ..helpers import increment_txnid
 from ..zodbsync import mod_read
 
+# Each data header in the Data.FS consists of oid, tid, prev, tloc, vlen and
+# plen, followed by plen bytes of pickle data or, if plen is zero, an 8 byte
+# backpointer. Object IDs are kept as integers, so the oid is read as an
+# unsigned 64 bit integer instead of 8 bytes.
+data_header = struct.Struct('>Q' + DATA_HDR[3:])
+assert data_header.size == DATA_HDR_LEN
+
+
+# Containers that store their children as attributes and list them in
+# _objects, so the children can be obtained without going through
+# objectItems().
+simple_containers = ('Folder', 'Folder (Ordered)')
+
+
+def object_items(obj):
+    """
+    Return the (id, object) pairs of the children of obj, like
+    obj.objectItems(), but reading them directly from the instance for simple
+    containers.
+    """
+    if getattr(obj, 'meta_type', None) not in simple_containers:
+        return obj.objectItems()
+    # Accessing _objects also unghostifies obj, so its __dict__ is filled
+    ids = [item['id'] for item in obj._objects]
+    attrs = getattr(obj, 'aq_base', obj).__dict__
+    return [(child_id, attrs[child_id]) for child_id in ids]
+
 
 class TreeOutdatedException(Exception):
     """Exception which is raised if the internal tree structure
@@ -23,6 +55,25 @@ class TreeOutdatedException(Exception):
     pass
 
 
+class TreeNode:
+    """Node in the object tree of Watch, describing one object"""
+    # The path is not stored, it is reconstructed from the ids in the
+    # children of the ancestors, see Watch._path
+    __slots__ = ('parent', 'children')
+
+    def __init__(self, parent, children):
+        self.parent = parent  # oid of the parent, None for the root object
+        self.children = children  # map oid -> id
+
+    # Pickle nodes as plain tuples instead of a dict of slot names to keep
+    # the data passed from the setup subprocess small
+    def __getstate__(self):
+        return (self.parent, self.children)
+
+    def __setstate__(self, state):
+        self.parent, self.children = state
+
+
 class Watch(SubCommand):
     """Periodically check for changes and record them"""
     # Connects to ZEO, builds a mirror of the tree structure of the objects,
@@ -30,6 +81,13 @@ class Watch(SubCommand):
     # to get the object IDs affected by those transactions, and updates its
     # tree structure as well as the file system tree structure accordingly.
 
+    # Signals that make us exit
+    signals = (signal.SIGTERM, signal.SIGHUP, signal.SIGINT)
+
+    # Format of the file written by store_tree_cache. Increase if the format
+    # of the object tree changes.
+    tree_cache_version = 1
+
     @staticmethod
     def add_args(parser):
         parser.add_argument(
@@ -45,6 +103,8 @@ class Watch(SubCommand):
         self.app = self.sync.app
         # an event that is fired if we are to be terminated
         self.exit = threading.Event()
+        # set while a step holds the lock and must not be interrupted
+        self.critical = False
 
         try:
             self.datafs_path = self.config["datafs_path"]
@@ -52,7 +112,11 @@ class Watch(SubCommand):
             self.logger.exception("watch requires datafs_path in config")
             raise
 
-        # mapping from object id to dict describing tree structure
+        # If set, the object tree is stored there when exiting and reused on
+        # the next start instead of building it from scratch.
+        self.tree_cache = self.config.get('watch_tree_cache')
+
+        # mapping from object id to TreeNode describing tree structure
         self.object_tree = {}
 
         # Mapping of additional object ids to OIDs of recorded objects. This is
@@ -67,6 +131,13 @@ class Watch(SubCommand):
         # method for this.
         self.additional_oids = {}
 
+        # Mapping of object ids to the serial with which they were last
+        # recorded. Objects that show up again with an unchanged serial do not
+        # need to be recorded again. The path is not part of it since objects
+        # that are moved or renamed are removed from the tree and from this
+        # mapping.
+        self.recorded = {}
+
     def _set_last_visible_txn(self):
         ''' Set self.last_visible_txn to a transaction ID such that every
         effect up to this ID is visible in the current transaction and every
@@ -82,46 +153,62 @@ class Watch(SubCommand):
             self.txnid_on_disk = self.last_visible_txn
             self.sync.txn_write(base64.b64encode(self.last_visible_txn))
 
-    def _init_tree(self, obj, parent_oid=None, path='/'):
+    def _path(self, oid):
+        ''' Return the path of the object with the given oid. '''
+        tree = self.object_tree
+        ids = []
+        node = tree[oid]
+        while node.parent is not None:
+            parent = tree[node.parent]
+            ids.append(parent.children[oid])
+            oid = node.parent
+            node = parent
+        return '/' + ''.join(obj_id + '/' for obj_id in reversed(ids))
+
+    def _init_tree(self, obj):
         ''' Insert obj and everything below into self.object_tree. '''
-        if not hasattr(obj, '_p_oid'):
-            # objects that have no oid are ignored
-            return None
-        # In some Python/Zope versions, _p_oid is a zodbpickle.binary, which is
-        # not pickleable. We always convert it into bytes.
-        oid = bytes(obj._p_oid)
-
-        children = {}  # map oid -> id
-
-        now = time.time()
-        if self.last_report is None:
-            self.last_report = now
-        if now - self.last_report > 2:
-            self.logger.info("Building tree: " + path)
-            self.last_report = now
-
-        self.object_tree[oid] = {
-            'parent': parent_oid,
-            'children': children,
-            'path': path,
-        }
+        # Walk the tree using an explicit stack instead of recursion. Each
+        # entry consists of the object, the OID of its parent and its id.
+        todo = [(obj, None, None)]
+        count = 0
+        while todo:
+            obj, parent_oid, obj_id = todo.pop()
+            if not hasattr(obj, '_p_oid'):
+                # objects that have no oid are ignored
+                continue
+            # Object IDs are stored as integers, which are smaller and faster
+            # to hash than the 8 byte strings used by the ZODB.
+            oid = u64(obj._p_oid)
+            if parent_oid is not None:
+                self.object_tree[parent_oid].children[oid] = obj_id
+
+            self.object_tree[oid] = TreeNode(
+                parent=parent_oid,
+                children={},
+            )
 
-        # If it turns out there are other objects needing such a hack, this
-        # should probably be moved to object_types
-        if obj.meta_type == 'User Folder':
-            self.additional_oids[bytes(obj.data._p_oid)] = oid
-            for user in obj.getUsers():
-                self.additional_oids[bytes(user._p_oid)] = oid
-
-        for child_id, child_obj in sorted(obj.objectItems()):
-            child_oid = self._init_tree(
-                obj=child_obj,
-                parent_oid=oid,
-                path=path+child_id+'/'
+            # Only look at the clock every so often
+            count += 1
+            if count % 1024 == 0:
+                now = time.time()
+                if self.last_report is None:
+                    self.last_report = now
+                if now - self.last_report > 2:
+                    self.logger.info("Building tree: " + self._path(oid))
+                    self.last_report = now
+
+            # If it turns out there are other objects needing such a hack,
+            # this should probably be moved to object_types
+            if obj.meta_type == 'User Folder':
+                self.additional_oids[u64(obj.data._p_oid)] = oid
+                for user in obj.getUsers():
+                    self.additional_oids[u64(user._p_oid)] = oid
+
+            # The order in which the children are visited does not matter
+            todo.extend(
+                (child_obj, oid, child_id)
+                for child_id, child_obj in object_items(obj)
             )
-            if child_oid:
-                children[child_oid] = child_id
-        return oid
 
     def _read_changed_oids(self, txn_start, txn_stop):
         """
@@ -129,13 +216,13 @@ class Watch(SubCommand):
         IDs between start and stop (incl.)
         """
         # FileIterator opens the Data.FS read-only and provides the following
-        # fields and methods:
+        # fields:
         # * _file: The file object for the opened Data.FS
-        # * _read_data_header(pos): reads a data header at some position in the
-        #   file
-        # * _ltid: the transaction id that was last read.
+        # * _pos: The position of the first transaction to be read
         # It is also possible to iterate over FileIterator, which yields
-        # transactions in the form of a TransactionRecord
+        # transactions in the form of a TransactionRecord. The data headers
+        # inside each transaction are parsed directly from a memory map of the
+        # file, which avoids a read call and a DataHeader object per record.
         self.changed_oids = set()
         if txn_start > txn_stop:
             return
@@ -144,50 +231,73 @@ class Watch(SubCommand):
             start=txn_start,
             stop=txn_stop,
         )
-        for txn in storage:
-            # Each TransactionRecord has the following fields:
-            # * _pos: Position of the first data header
-            # * _tend: End of the last data block
-            # * _file: A reference to the file
-            pos = txn._pos
-            while pos < txn._tend:
-                dhead = storage._read_data_header(pos)
-                # each data header has the fields and methods
-                # * _recordlen(): gives the total length. Adding recordlen()
-                #   advances to the next data header
-                # * oid: the object ID
-                # * plen: the size of the pickle data, which comes after the
-                #   header
-                dlen = dhead.recordlen()
-                oid = self.additional_oids.get(bytes(dhead.oid),
-                                               bytes(dhead.oid))
-                self.changed_oids.add(oid)
-                pos = pos + dlen
+        if hasattr(os, 'posix_fadvise'):
+            # Everything from the starting position is read exactly once, so
+            # allow the kernel to read ahead more aggressively
+            os.posix_fadvise(storage._file.fileno(), storage._pos, 0,
+                             os.POSIX_FADV_SEQUENTIAL)
+        oids = set()
+        # All transactions up to txn_stop are completely written, so they are
+        # covered by a map of the file as it is now.
+        fileno = storage._file.fileno()
+        with mmap.mmap(fileno, 0, access=mmap.ACCESS_READ) as datafs:
+            for txn in storage:
+                # Each TransactionRecord has the following fields:
+                # * _pos: Position of the first data header
+                # * _tend: End of the last data block
+                pos = txn._pos
+                while pos < txn._tend:
+                    oid, _, _, _, _, plen = data_header.unpack_from(
+                        datafs, pos
+                    )
+                    oids.add(oid)
+                    pos += DATA_HDR_LEN + (plen or 8)
+
+        if self.additional_oids:
+            # Replace additional OIDs by the OIDs of the recorded objects
+            additional = [oid for oid in oids if oid in self.additional_oids]
+            for oid in additional:
+                oids.remove(oid)
+                oid = self.additional_oids[oid]
+                oids.add(oid)
+                # The serial of the recorded object itself did not change
+                self.recorded.pop(oid, None)
+        self.changed_oids = oids
 
     def _remove_subtree(self, oid):
         """
         Remove a subtree from self.object_tree
         """
+        tree = self.object_tree
+        recorded = self.recorded
         todo = [oid]
         while todo:
             oid = todo.pop()
-            todo.extend(self.object_tree[oid]['children'])
-            del self.object_tree[oid]
+            todo.extend(tree.pop(oid).children)
+            recorded.pop(oid, None)
 
     def _record_object(self, oid):
         '''
         Store data of an object at the path stored in our object tree.
         '''
-        path = self.object_tree[oid]['path']
+        path = self._path(oid)
+        obj = self.app._p_jar[p64(oid)]
+        # A ghost might still carry the serial of an outdated state
+        obj._p_activate()
+        serial = obj._p_serial
+        if self.recorded.get(oid) == serial:
+            self.logger.debug('Skipping unchanged %s' % path)
+            return
+
         self.logger.info('Recording %s' % path)
         self.logger.debug('OID: ' + repr(oid))
 
-        obj = self.app._p_jar[oid]
         data = mod_read(
             obj=obj,
             default_owner=self.sync.default_owner
         )
         self.sync.fs_write(path=path, data=data)
+        self.recorded[oid] = serial
 
     def _update_objects(self):
         '''
@@ -203,7 +313,11 @@ class Watch(SubCommand):
         while len(self.changed_oids):
             # not all oids are part of our object tree yet, so we have to
             # iteratively update some at a time
-            next_oids = self.changed_oids.intersection(self.object_tree.keys())
+            # Only iterate over the changed oids, intersecting with the keys
+            # view would iterate over the whole tree
+            next_oids = {
+                oid for oid in self.changed_oids if oid in self.object_tree
+            }
             if not len(next_oids):
                 # The remaining oids are not reachable by any of the currently
                 # existing nodes. This can happen during initialization, since
@@ -211,6 +325,9 @@ class Watch(SubCommand):
                 # transaction chain and then affected objects are collected for
                 # earlier transactions, but they might no longer exist
                 break
+            # Let the storage load the objects in the background so the
+            # following accesses do not need a round trip each
+            self.app._p_jar.prefetch([p64(oid) for oid in next_oids])
             for oid in next_oids:
                 if oid not in self.object_tree:
                     # Might have vanished from the tree in an earlier iteration
@@ -228,46 +345,49 @@ class Watch(SubCommand):
         children. Remove any superfluous children (oid not found or wrong id)
         and record any new children recursively.
         '''
-        obj = self.app._p_jar[oid]
+        obj = self.app._p_jar[p64(oid)]
         node = self.object_tree[oid]
 
-        newchildren = {}
-        for child_id, child_obj in obj.objectItems():
-            if not hasattr(child_obj, '_p_oid'):
-                continue
-            newchildren[bytes(child_obj._p_oid)] = child_id
+        newchildren = {
+            u64(child_obj._p_oid): child_id
+            for child_id, child_obj in object_items(obj)
+            if hasattr(child_obj, '_p_oid')
+        }
 
-        # Go through old children and check if some are to be deleted
-        for child_oid, child_id in list(node['children'].items()):
-            if newchildren.get(child_oid) == child_id:
-                continue
+        # Old children are to be deleted if they vanished or were renamed. The
+        # set operations on the key views only leave the common children to be
+        # compared in Python.
+        children = node.children
+        removed = children.keys() - newchildren.keys()
+        removed.update(
+            child_oid for child_oid in children.keys() & newchildren.keys()
+            if children[child_oid] != newchildren[child_oid]
+        )
+        for child_oid in removed:
             self._remove_subtree(child_oid)
-            del node['children'][child_oid]
+            del children[child_oid]
 
-        pathinfo = self.sync.fs_pathinfo(node['path'])
+        path = self._path(oid)
+        pathinfo = self.sync.fs_pathinfo(path)
         self.sync.fs_prune(pathinfo, newchildren.values())
 
         # Add new children to changed_oids so they will also be recorded
-        for child_oid, child_id in list(newchildren.items()):
-            if child_oid in node['children']:
-                continue
-            newpath = node['path']+child_id+'/'
-
+        for child_oid in newchildren.keys() - children.keys():
+            child_id = newchildren[child_oid]
             if child_oid in self.object_tree:
                 # The parent changed. Remove from there. Since the old parent
                 # will also be changed, the call to fs_prune there will take
                 # care of removing everything on the FS.
-                old_parent = self.object_tree[child_oid]['parent']
-                del self.object_tree[old_parent]['children'][child_oid]
+                old_parent = self.object_tree[child_oid].parent
+                del self.object_tree[old_parent].children[child_oid]
                 self._remove_subtree(child_oid)
 
             self.changed_oids.add(child_oid)
-            self.object_tree[child_oid] = {
-                'parent': oid,
-                'children': {},
-                'path': newpath,
-            }
-            node['children'][child_oid] = child_id
+            self.object_tree[child_oid] = TreeNode(
+                parent=oid,
+                children={},
+            )
+            children[child_oid] = child_id
 
     def quit(self, signo, _frame):
         """
@@ -276,14 +396,18 @@ class Watch(SubCommand):
         self.logger.info('Caught signal, exiting...')
         self.unregister_signals()
         self.exit.set()
+        if not self.critical:
+            # We are sleeping or waiting for the lock, so there is nothing to
+            # finish before exiting.
+            sys.exit()
 
     def register_signals(self):
-        for sig in ('TERM', 'HUP', 'INT'):
-            signal.signal(getattr(signal, 'SIG'+sig), self.quit)
+        for signo in self.signals:
+            signal.signal(signo, self.quit)
 
     def unregister_signals(self):
-        for sig in ('TERM', 'HUP', 'INT'):
-            signal.signal(getattr(signal, 'SIG'+sig), signal.SIG_DFL)
+        for signo in self.signals:
+            signal.signal(signo, signal.SIG_DFL)
 
     def setup(self):
         """
@@ -336,9 +460,10 @@ class Watch(SubCommand):
             )
             paths = []
             while len(self.changed_oids):
-                next_oids = self.changed_oids.intersection(
-                    self.object_tree.keys()
-                )
+                next_oids = {
+                    oid for oid in self.changed_oids
+                    if oid in self.object_tree
+                }
                 if not len(next_oids):
                     # The remaining oids are not reachable by any of the
                     # currently existing nodes. This can happen during
@@ -348,7 +473,7 @@ class Watch(SubCommand):
                     # but they might no longer exist
                     break
                 paths.extend(
-                    [self.object_tree[oid]['path'] for oid in next_oids]
+                    [self._path(oid) for oid in next_oids]
                 )
                 self.changed_oids.difference_update(next_oids)
 
@@ -373,33 +498,127 @@ class Watch(SubCommand):
         """
         cmd = [sys.executable, sys.argv[0], '--config', self.args.config,
                'watch', '--init']
-        data = pickle.loads(subprocess.check_output(cmd))
+        # Unpickle directly from the pipe so the pickled data is never held in
+        # memory as a whole in addition to the unpickled tree.
+        error = None
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE) as proc:
+            try:
+                data = pickle.load(proc.stdout)
+            except (EOFError, pickle.UnpicklingError) as exc:
+                error = exc
+        # A failing subprocess usually also leaves incomplete data, so report
+        # its exit status first
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+        if error is not None:
+            raise error
         self.object_tree = data['tree']
         self.additional_oids = data['add_oids']
         self.last_visible_txn = self.txnid_on_disk = data['txn']
 
-    def dump_setup_data(self, stream=sys.stdout):
-        """
-        Print pickled setup data for usage in main process.
-        """
-        data = {
+    def _setup_data(self):
+        ''' Return the data that a new process needs to skip the setup. '''
+        return {
             'tree': self.object_tree,
             'add_oids': self.additional_oids,
             'txn': self.last_visible_txn,
         }
-        # write binary to stdout - in Py3, this requires using
-        # sys.stdout.buffer, in Py2 sys.stdout itself is used.
-        pickle.dump(data, file=getattr(stream, 'buffer', stream))
+
+    def dump_setup_data(self, stream=sys.stdout):
+        """
+        Print pickled setup data for usage in main process.
+        """
+        data = self._setup_data()
+        # The pickle is binary, so write to the underlying buffer of a text
+        # stream like sys.stdout. Binary streams are used directly.
+        pickle.dump(
+            data,
+            file=getattr(stream, 'buffer', stream),
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+
+    def _datafs_id(self):
+        '''
+        Identify the file at datafs_path. A different Data.FS that was put at
+        the same path, for example by restoring a backup, has different object
+        IDs. Packing also replaces the file, which unnecessarily but safely
+        invalidates the tree cache.
+        '''
+        stat = os.stat(self.datafs_path)
+        return (stat.st_dev, stat.st_ino)
+
+    def load_tree_cache(self):
+        """
+        Load the setup data stored by a previous process, which spares us the
+        setup. This is only possible if it was created for the same Data.FS,
+        identified by its path and inode, and the file system still mirrors
+        the transaction the stored tree belongs to. Returns True if the data
+        could be used.
+
+        The file is removed before reading, so it is only used again if this
+        process also exits cleanly and stores its tree. A file that can not be
+        used is thereby also not tried again on the next start.
+        """
+        if not self.tree_cache or not os.path.exists(self.tree_cache):
+            return False
+        try:
+            with open(self.tree_cache, 'rb') as f:
+                os.remove(self.tree_cache)
+                data = pickle.load(f)
+            txnid_on_disk = self.sync.txn_read()
+            usable = (
+                data['version'] == self.tree_cache_version
+                and data['datafs_path'] == self.datafs_path
+                and data['datafs_id'] == self._datafs_id()
+                and txnid_on_disk is not None
+                and base64.b64decode(txnid_on_disk) == data['txn']
+                and data['txn'] <= self.app._p_jar._db.lastTransaction()
+            )
+        except Exception:
+            # A truncated file or one written by an incompatible version can
+            # fail in many ways, none of which should prevent starting
+            self.logger.debug("Unable to read tree cache", exc_info=True)
+            usable = False
+        if not usable:
+            self.logger.info("Ignoring outdated tree cache")
+            return False
+        self.object_tree = data['tree']
+        self.additional_oids = data['add_oids']
+        self.last_visible_txn = self.txnid_on_disk = data['txn']
+        self.logger.info("Loaded tree from cache")
+        return True
+
+    def store_tree_cache(self):
+        """
+        Store the setup data for the next process if the object tree matches
+        the transaction that is recorded on the file system, which is not the
+        case if a step was aborted.
+        """
+        if not self.tree_cache:
+            return
+        if self.last_visible_txn != self.txnid_on_disk:
+            return
+        data = self._setup_data()
+        data['version'] = self.tree_cache_version
+        data['datafs_path'] = self.datafs_path
+        data['datafs_id'] = self._datafs_id()
+        tmp = self.tree_cache + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(data, file=f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.tree_cache)
 
     def step(self):
         """Read new transactions, update the object tree and record all
         changes."""
-        self.unregister_signals()
+        start_txnid = increment_txnid(self.last_visible_txn)
+        if start_txnid > self.app._p_jar._db.lastTransaction():
+            # Nothing was committed since the last step, so there is no need
+            # to take the lock or look into the Data.FS
+            return
+
         self.acquire_lock(timeout=300)
+        self.critical = True
         try:
-            self.register_signals()
-
-            start_txnid = increment_txnid(self.last_visible_txn)
             self._set_last_visible_txn()
             self._read_changed_oids(
                 txn_start=start_txnid,
@@ -418,7 +637,9 @@ class Watch(SubCommand):
             )
             self.exit.set()
         finally:
+            # Only allow being interrupted once the lock is released
             self.release_lock()
+            self.critical = False
 
     def run(self, interval=10):
         """ Setup and run in a loop. """
@@ -426,9 +647,16 @@ class Watch(SubCommand):
             self.setup()
             self.dump_setup_data()
             return
-        else:
+        elif not self.load_tree_cache():
             self.spawned_setup()
-        while not self.exit.is_set():
-            self.step()
-            # a wait that is interrupted immediately if exit.set() is called
-            self.exit.wait(interval)
+        # A signal received during a step only terminates the loop after the
+        # step is finished
+        self.register_signals()
+        try:
+            while not self.exit.is_set():
+                self.step()
+                # a wait that is interrupted immediately if exit.set() is
+                # called
+                self.exit.wait(interval)
+        finally:
+            self.store_tree_cache()
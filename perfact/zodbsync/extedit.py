@@ -4,6 +4,7 @@ import json
 from base64 import b64encode, b64decode
 
 from .zodbsync import mod_read, mod_write
+from .helpers import prop_dict
 
 
 def launch(context, script, path, source=None, orig_source=None,
@@ -113,20 +114,15 @@ def controlfile(context, path, url):
     if encoding:
         headers.append(('encoding', encoding))
 
-    props = data.get('props', [])
-    for prop in props:
-        if ('id', 'content_type') in prop:
-            value = [pair for pair in prop if pair[0] == 'value']
-            assert len(value), "Invalid property"
-            headers.append(('content-type', value[0][1]))
-            break
+    content_type = prop_dict(data).get('content_type')
+    if content_type is not None:
+        headers.append(('content-type', content_type))
 
-    result = ''.join([
-        '{}: {}\n'.format(*header)
-        for header in headers
-    ]) + '\n' + data['source']
-
-    return result
+    # Join everything at once to avoid copying the source again
+    lines = ['{}: {}\n'.format(*header) for header in headers]
+    lines.append('\n')
+    lines.append(data['source'])
+    return ''.join(lines)
 
 
 def update(context, path, source, orig_source, encoding):
@@ -147,6 +143,10 @@ def update(context, path, source, orig_source, encoding):
     if data['source'] != orig_source:
         return {'error': 'Object was changed in the meantime. Please reload.'}
 
+    if source == orig_source:
+        # Saved without changes, no need to write the object
+        return {'success': True}
+
     if encoding == 'base64':
         data['source'] = b64decode(source)
     elif encoding is None:
@@ -41,15 +41,16 @@ def remove_redundant_paths(paths):
     included, remove /a/b/. Works in-place and also returns the list.
     '''
     paths.sort()
-    i = 0
+    keep = []
     last = None
-    while i < len(paths):
-        current = paths[i].rstrip('/') + '/'
+    for path in paths:
+        current = path.rstrip('/') + '/'
         if last is not None and current.startswith(last):
-            del paths[i]
             continue
+        keep.append(path)
         last = current
-        i += 1
+    # Deleting single elements would be quadratic for long lists
+    paths[:] = keep
     return paths
 
 
@@ -67,14 +68,16 @@ class StrRepr:
     '''
     def _collect(self, data, level=0, nl='\n'):
         "Internal recursion worker"
+        append = self.output.append
 
-        if not isinstance(data, (list, tuple)):
-            self.output.append(repr(data))
+        is_list = isinstance(data, list)
+        if not is_list and not isinstance(data, tuple):
+            append(repr(data))
             return
 
         # start new line for each element
         linesep = (level == 0
-                   or level == 2 and isinstance(data, list)
+                   or level == 2 and is_list
                    or level in self.seprules.get(self.section, []))
         if self.legacy and len(data) < 2:
             linesep = False
@@ -82,31 +85,32 @@ class StrRepr:
         # split
         lastsep = linesep
 
-        if isinstance(data, list):
+        if is_list:
             opn, cls = '[', ']'
-
-        if isinstance(data, tuple):
+        else:
             opn, cls = '(', ')'
             if len(data) == 1:
                 lastsep = True
 
-        self.output.append(opn)
+        append(opn)
         incnl = nl + '    '
+        collect = self._collect
+        last = len(data) - 1
         for idx, item in enumerate(data):
             if level == 0:
                 self.section = item[0]
             if linesep:
-                self.output.append(incnl)
-                self._collect(item, level+1, incnl)
-                self.output.append(',')
+                append(incnl)
+                collect(item, level+1, incnl)
+                append(',')
             else:
-                self._collect(item, level+1, nl)
-                if idx < len(data) - 1 or lastsep:
-                    self.output.append(', ')
+                collect(item, level+1, nl)
+                if idx < last or lastsep:
+                    append(', ')
         if self.legacy and linesep and level > 0:
-            self.output.append(incnl+cls)
+            append(incnl+cls)
         else:
-            self.output.append(nl+cls if linesep else cls)
+            append(nl+cls if linesep else cls)
 
     def __call__(self, data, seprules=None, legacy=False):
         "Collect output parts recursively and return their concatenation"
@@ -127,16 +131,60 @@ def read_pdata(obj):
         source = obj.data
     else:
         data = obj.data
-        if isinstance(data.data, bytes):
-            source = b''
-        elif isinstance(data.data, str):
-            source = ''
+        empty = b'' if isinstance(data.data, bytes) else ''
+        # Join at the end instead of concatenating for each chunk, which
+        # would copy the data read so far each time
+        chunks = []
         while data is not None:
-            source += data.data
+            chunks.append(data.data)
             data = data.next
+        source = empty.join(chunks)
     return source
 
 
+# Operators supported by literal_eval
+bin_ops = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.Mod: operator.mod,
+}
+
+unary_ops = {
+    ast.USub: operator.neg,
+}
+
+
+def _convert(node):
+    "Recursion worker for literal_eval"
+    converter = _converters.get(type(node))
+    if converter is None:
+        raise Exception('Unsupported type {}'.format(repr(node)))
+    return converter(node)
+
+
+# Conversion for each supported node type, looked up by the exact type instead
+# of checking each type in turn
+_converters = {
+    # Strings, bytes, numbers, None, True and False
+    ast.Constant: lambda node: node.value,
+    ast.Expression: lambda node: _convert(node.body),
+    ast.Tuple: lambda node: tuple(map(_convert, node.elts)),
+    ast.List: lambda node: list(map(_convert, node.elts)),
+    ast.Dict: lambda node: dict(
+        (_convert(k), _convert(v)) for k, v in zip(node.keys, node.values)
+    ),
+    ast.BinOp: lambda node: bin_ops[type(node.op)](
+        _convert(node.left),
+        _convert(node.right)
+    ),
+    ast.UnaryOp: lambda node: unary_ops[type(node.op)](
+        _convert(node.operand)
+    ),
+}
+
+
 def literal_eval(value):
     '''Literal evaluator (with a bit more power than PT).
 
@@ -145,61 +193,31 @@ def literal_eval(value):
     '''
     if isinstance(value, (bytes, str)):
         value = ast.parse(value, mode='eval')
-
-    bin_ops = {
-        ast.Add: operator.add,
-        ast.Sub: operator.sub,
-        ast.Mult: operator.mul,
-        ast.Div: operator.truediv,
-        ast.Mod: operator.mod,
-    }
-
-    unary_ops = {
-        ast.USub: operator.neg,
-    }
-
-    def _convert(node):
-        if isinstance(node, ast.Expression):
-            return _convert(node.body)
-        elif isinstance(node, ast.Str):
-            return node.s
-        elif isinstance(node, ast.Bytes):  # pragma: nocover_py2
-            return node.s
-        elif isinstance(node, ast.Num):
-            return node.n
-        elif isinstance(node, ast.Tuple):
-            return tuple(map(_convert, node.elts))
-        elif isinstance(node, ast.List):
-            return list(map(_convert, node.elts))
-        elif isinstance(node, ast.Dict):
-            return dict((_convert(k), _convert(v)) for k, v
-                        in zip(node.keys, node.values))
-        elif isinstance(node, ast.NameConstant):
-            return node.value
-        elif isinstance(node, ast.BinOp):
-            return bin_ops[type(node.op)](
-                _convert(node.left),
-                _convert(node.right)
-            )
-        elif isinstance(node, ast.UnaryOp):
-            return unary_ops[type(node.op)](_convert(node.operand))
-        raise Exception('Unsupported type {}'.format(repr(node)))
     return _convert(value)
 
 
 def prop_dict(data):
     props = {}
 
-    # Get the properties from object data
-    p = dict(data).get('props', None)
+    # Get the properties from object data, which is either a dict or a list
+    # of (key, value) pairs. Only copy the latter if needed.
+    if isinstance(data, dict):
+        p = data.get('props', None)
+    else:
+        p = next((value for key, value in data if key == 'props'), None)
     if not p:
         return props
 
-    # Convert each property into a dictionary
+    # Each property is a sequence of (key, value) pairs, from which only the
+    # id and the value are needed
     for item in p:
-        pd = dict(item)
-        # Extract only the value
-        props[pd['id']] = pd['value']
+        prop_id = prop_value = None
+        for key, value in item:
+            if key == 'id':
+                prop_id = value
+            elif key == 'value':
+                prop_value = value
+        props[prop_id] = prop_value
 
     return props
 
@@ -223,16 +241,9 @@ def load_config(filename):
 # Helper for handling transaction IDs (which are byte strings of length 8)
 def increment_txnid(s):
     ''' add 1 to s, but for s being a string of bytes'''
-    arr = bytearray(s)
-    pos = len(arr)-1
-    while pos >= 0:
-        if arr[pos] == 255:
-            arr[pos] = 0
-            pos -= 1
-        else:
-            arr[pos] += 1
-            break
-    return bytes(arr)
+    # Interpret as big endian number, wrapping around on overflow
+    value = (int.from_bytes(s, 'big') + 1) % (1 << (8 * len(s)))
+    return value.to_bytes(len(s), 'big')
 
 
 def obj_modtime(obj):  # pragma: no cover
@@ -251,29 +262,10 @@ def db_modtime(context):  # pragma: no cover
 
 def path_diff(old, new):
     """
-    For two lists of tuples (path, checksum) that are ordered by path, return
-    the set of all paths that differ, i.e. either are only present in one of
-    the lists or have a different checksum.
+    For two lists of tuples (path, checksum), return the set of all paths that
+    differ, i.e. either are only present in one of the lists or have a
+    different checksum.
     """
-    result = set()
-    oldidx = 0
-    newidx = 0
-    # Iterate through results, which are ordered by path. Add any
-    # deviation to paths
-    while oldidx < len(old) and newidx < len(new):
-        if old[oldidx] == new[newidx]:
-            oldidx += 1
-            newidx += 1
-            continue
-        oldpath = old[oldidx][0]
-        newpath = new[newidx][0]
-        if oldpath <= newpath:
-            result.add(oldpath)
-            oldidx += 1
-            continue
-        if newpath <= oldpath:
-            result.add(newpath)
-            newidx += 1
-    result.update([row[0] for row in old[oldidx:]])
-    result.update([row[0] for row in new[newidx:]])
-    return result
+    # Each path that differs has an entry that is only present in one of the
+    # lists
+    return {path for path, checksum in set(old).symmetric_difference(new)}
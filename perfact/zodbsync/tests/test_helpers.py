@@ -125,6 +125,13 @@ def test_literal_eval():
         helpers.literal_eval('f(1)')
 
 
+def test_increment_txnid():
+    """Check carrying over to higher bytes and wrapping around."""
+    assert helpers.increment_txnid(b'\x00' * 8) == b'\x00' * 7 + b'\x01'
+    assert helpers.increment_txnid(b'\x01\xff') == b'\x02\x00'
+    assert helpers.increment_txnid(b'\xff' * 8) == b'\x00' * 8
+
+
 def test_path_diff():
     """Check that path_diff also handles cases where the last element is not
     the same in both lists."""
@@ -1,4 +1,5 @@
 import os
+import signal
 import time
 import os.path
 import base64
@@ -15,6 +16,7 @@ from contextlib import contextmanager
 
 import ZEO
 import transaction
+from ZODB.utils import u64
 from AccessControl.SecurityManagement import newSecurityManager
 
 try:
@@ -142,6 +144,27 @@ class TestSync():
         with self.newconn() as conn:
             yield conn
 
+    @pytest.fixture(scope='function')
+    def tree_cache(self):
+        """
+        Fixture that provides a path for the tree cache of the watcher
+        """
+        tmpdir = tempfile.mkdtemp()
+        yield os.path.join(tmpdir, 'tree')
+        shutil.rmtree(tmpdir)
+
+    @contextmanager
+    def signals_restored(self, watcher):
+        "Restore the signal handlers changed by the watcher"
+        handlers = {
+            signo: signal.getsignal(signo) for signo in watcher.signals
+        }
+        try:
+            yield
+        finally:
+            for signo, handler in handlers.items():
+                signal.signal(signo, handler)
+
     def mkrunner(self, *cmd):
         '''
         Create or update runner for given zodbsync command
@@ -699,6 +722,23 @@ class TestSync():
         assert open(root + 'test1' + src).read() == 'test1'
         assert open(root + 'test2' + src).read() == 'test2'
 
+    def test_watch_quit(self):
+        """
+        A signal received while a step is running only makes the watcher exit
+        after the step, otherwise it exits immediately.
+        """
+        watcher = self.mkrunner('watch')
+        with self.signals_restored(watcher):
+            watcher.critical = True
+            watcher.quit(signal.SIGTERM, None)
+            assert watcher.exit.is_set()
+
+            watcher.exit.clear()
+            watcher.critical = False
+            with pytest.raises(SystemExit):
+                watcher.quit(signal.SIGTERM, None)
+            assert watcher.exit.is_set()
+
     def test_watch_dump_setup(self):
         """
         Check output that a spawned initialization subprocess would generate.
@@ -709,12 +749,132 @@ class TestSync():
         watcher.dump_setup_data(stream=stream)
         data = pickle.loads(stream.getvalue())
         assert set(data.keys()) == {'tree', 'txn', 'add_oids'}
+        watcher.object_tree = data['tree']
         tofind = ['/', '/acl_users/', '/index_html/']
-        for obj in data['tree'].values():
-            if obj['path'] in tofind:
-                tofind.remove(obj['path'])
+        for oid in data['tree']:
+            path = watcher._path(oid)
+            if path in tofind:
+                tofind.remove(path)
         assert tofind == []
 
+    def test_watch_skip_unchanged(self):
+        """
+        Make sure an object that is processed again without its serial having
+        changed is not written again.
+        """
+        watcher = self.mkrunner('watch')
+        watcher.setup()
+        oid = u64(self.app.index_html._p_oid)
+        with mock.patch.object(watcher.sync, 'fs_write') as fs_write:
+            for i in range(2):
+                watcher.changed_oids = {oid}
+                watcher._update_objects()
+        assert fs_write.call_count == 1
+
+    def test_watch_additional_oids(self, conn):
+        """
+        Make sure the User Folder is recorded again if only its user data,
+        which is stored in separate objects, changed.
+        """
+        watcher = self.mkrunner('watch')
+        watcher.setup()
+        oid = u64(self.app.acl_users._p_oid)
+        watcher.changed_oids = {oid}
+        watcher._update_objects()
+        assert oid in watcher.recorded
+
+        with mock.patch.object(watcher.sync, 'fs_write') as fs_write:
+            with conn.tm:
+                conn.app.acl_users._doAddUser('watchuser', 'pw', [], [])
+            self.watcher_step_until(watcher, lambda: any(
+                call.kwargs['path'] == '/acl_users/'
+                for call in fs_write.call_args_list
+            ))
+
+    def mkwatcher_with_cache(self, tree_cache):
+        "Create a watcher using the given tree cache and run its setup"
+        watcher = self.mkrunner('watch')
+        watcher.tree_cache = tree_cache
+        watcher.setup()
+        return watcher
+
+    def test_watch_tree_cache(self, tree_cache):
+        """
+        Store the tree of a watcher and make sure a new watcher uses it instead
+        of running the setup, storing it again when exiting.
+        """
+        watcher = self.mkwatcher_with_cache(tree_cache)
+        watcher.store_tree_cache()
+        assert os.path.exists(tree_cache)
+
+        second = self.mkrunner('watch')
+        second.tree_cache = tree_cache
+        # Only start and exit again
+        second.exit.set()
+        with self.signals_restored(second):
+            with mock.patch.object(second, 'spawned_setup') as setup:
+                second.run()
+        assert not setup.called
+        assert second.object_tree.keys() == watcher.object_tree.keys()
+        assert second.last_visible_txn == watcher.last_visible_txn
+        assert os.path.exists(tree_cache)
+
+    def test_watch_tree_cache_other_txn(self, tree_cache):
+        """
+        Make sure the tree cache is not used if the repository was recorded
+        with a different transaction in the meantime.
+        """
+        watcher = self.mkwatcher_with_cache(tree_cache)
+        watcher.store_tree_cache()
+        orig = watcher.sync.txn_read()
+        watcher.sync.txn_write(base64.b64encode(b'\x00' * 8))
+        try:
+            assert not watcher.load_tree_cache()
+        finally:
+            watcher.sync.txn_write(orig)
+        assert not os.path.exists(tree_cache)
+
+    def test_watch_tree_cache_other_datafs(self, tree_cache):
+        """
+        Make sure the tree cache is not used for a different Data.FS.
+        """
+        watcher = self.mkwatcher_with_cache(tree_cache)
+        watcher.store_tree_cache()
+        watcher.datafs_path += '.other'
+        assert not watcher.load_tree_cache()
+        assert not os.path.exists(tree_cache)
+
+    def test_watch_tree_cache_replaced_datafs(self, tree_cache):
+        """
+        Make sure the tree cache is not used if a different Data.FS was put at
+        the same path.
+        """
+        watcher = self.mkwatcher_with_cache(tree_cache)
+        watcher.store_tree_cache()
+        with mock.patch.object(watcher, '_datafs_id', return_value=(0, 0)):
+            assert not watcher.load_tree_cache()
+        assert not os.path.exists(tree_cache)
+
+    def test_watch_tree_cache_corrupt(self, tree_cache):
+        """
+        Make sure an unreadable tree cache is ignored and removed.
+        """
+        watcher = self.mkwatcher_with_cache(tree_cache)
+        with open(tree_cache, 'wb') as f:
+            f.write(b'garbage')
+        assert not watcher.load_tree_cache()
+        assert not os.path.exists(tree_cache)
+
+    def test_watch_tree_cache_outdated_tree(self, tree_cache):
+        """
+        Make sure the tree is not stored if it does not match the transaction
+        recorded in the repository.
+        """
+        watcher = self.mkwatcher_with_cache(tree_cache)
+        watcher.txnid_on_disk = b'\x00' * 8
+        watcher.store_tree_cache()
+        assert not os.path.exists(tree_cache)
+
     def test_reset(self):
         """
         Change the title of index_html in a second branch, reset to it and
@@ -829,6 +989,19 @@ class TestSync():
             )
             assert 'error' in json.loads(res)
 
+            # Saving without changes succeeds without writing the object
+            with mock.patch.object(extedit, 'mod_write') as mod_write:
+                res = extedit.launch(
+                    self.app,
+                    self.app.index_html,
+                    '/index_html',
+                    source=new_source,
+                    orig_source=new_source,
+                    encoding=encoding,
+                )
+            assert 'success' in json.loads(res)
+            assert not mod_write.called
+
             # Check for error on invalid path
             res = extedit.launch(
                 self.app,
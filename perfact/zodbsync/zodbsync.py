@@ -54,9 +54,6 @@ def mod_read(obj=None, onerrorstop=False, default_owner=None,
              force_default_owner=False):
     '''Build a consistent metadata dictionary for all types.'''
 
-    # Known types:
-    known_types = list(object_handlers.keys())
-
     # TODO:
     # - Preconditions ?
     # - Site Access Rules ?
@@ -76,7 +73,7 @@ def mod_read(obj=None, onerrorstop=False, default_owner=None,
 
     # Generic and meta type dependent handlers
 
-    if meta_type not in known_types:
+    if meta_type not in object_handlers:
         if onerrorstop:
             assert False, "Unsupported type: %s" % meta_type
         else: